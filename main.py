@@ -1,17 +1,27 @@
 # pip freeze > requirements.txt
+# Chạy: uvicorn main:app --loop uvloop --http httptools --workers N (xem render.yaml)
 
 
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, EmailStr, HttpUrl
-import firebase_admin
-from firebase_admin import credentials, auth
+from google.oauth2 import service_account
+import google.auth.transport.requests
+import httpx
+import asyncio
 import datetime
-import random
-import string
+import time
+import uuid
 import os
-import redis
-import yagmail
+from secrets import randbelow
+from contextlib import asynccontextmanager
+from email.message import EmailMessage
+from urllib.parse import urlsplit, parse_qs
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+import aiosmtplib
+import orjson
 from dotenv import load_dotenv
 from typing import List, Optional, Any
 
@@ -26,38 +36,103 @@ REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 GMAIL_USERNAME = os.getenv("GMAIL_USERNAME")
 GMAIL_APP_PASSWORD = os.getenv("GMAIL_APP_PASSWORD")
 
-# Khởi tạo Firebase Admin SDK
+# Khởi tạo thông tin xác thực cho Firebase Auth
+# Gọi thẳng Identity Toolkit REST API (API mà firebase_admin.auth bọc lại) bằng một httpx.AsyncClient
+# dùng chung (HTTP/2, giữ kết nối) để không chặn event loop; access token OAuth2 được cache tới khi hết hạn
+GOOGLE_AUTH_SCOPES = [
+    "https://www.googleapis.com/auth/cloud-platform",
+    "https://www.googleapis.com/auth/identitytoolkit",
+]
+google_credentials = None
+IDENTITY_TOOLKIT_URL = None
 try:
     if not SERVICE_ACCOUNT_KEY_PATH:
         raise ValueError("FIREBASE_SERVICE_ACCOUNT_KEY_PATH không được đặt.")
-    if not firebase_admin._apps:
-        cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
-        firebase_admin.initialize_app(cred)
+    google_credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_KEY_PATH, scopes=GOOGLE_AUTH_SCOPES)
+    IDENTITY_TOOLKIT_URL = f"https://identitytoolkit.googleapis.com/v1/projects/{google_credentials.project_id}/accounts"
 except Exception as e:
-    print(f"Lỗi khởi tạo Firebase Admin SDK: {e}")
+    print(f"Lỗi khởi tạo thông tin xác thực Firebase: {e}")
     # exit()
 
-# Khởi tạo Redis client
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True, username=REDIS_USERNAME, password=REDIS_PASSWORD)
-    redis_client.ping() # Kiểm tra kết nối
-    print("Kết nối Redis thành công!")
-except redis.exceptions.ConnectionError as e:
-    print(f"Lỗi kết nối Redis: {e}")
-    # exit()
+http_client = httpx.AsyncClient(http2=True, timeout=10.0)
+google_token_lock = asyncio.Lock()
+
+# Khởi tạo Redis client (bất đồng bộ, dùng chung một connection pool)
+# Kết nối thực sự được mở và kiểm tra trong lifespan của app
+redis_pool = aioredis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=0,
+    username=REDIS_USERNAME,
+    password=REDIS_PASSWORD,
+    max_connections=50,
+    decode_responses=True,
+)
+redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+# Khởi tạo pool kết nối SMTP (aiosmtplib) để gửi email
+# Các kết nối được giữ lâu dài để không phải bắt tay TLS + AUTH cho mỗi email;
+# mỗi kết nối chỉ được một coroutine dùng tại một thời điểm (lấy ra/trả vào Queue)
+SMTP_HOSTNAME = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_POOL_SIZE = 4
+smtp_connections = [aiosmtplib.SMTP(hostname=SMTP_HOSTNAME, port=SMTP_PORT, use_tls=True) for _ in range(SMTP_POOL_SIZE)]
+smtp_pool: asyncio.Queue = asyncio.Queue(maxsize=SMTP_POOL_SIZE)
+for smtp in smtp_connections:
+    smtp_pool.put_nowait(smtp)
+
+async def connect_smtp(smtp: aiosmtplib.SMTP):
+    await smtp.connect()
+    try:
+        await smtp.login(GMAIL_USERNAME, GMAIL_APP_PASSWORD)
+    except Exception:
+        smtp.close()
+        raise
 
-# Khởi tạo yagmail (để gửi email)
-try:
-    if not GMAIL_USERNAME or not GMAIL_APP_PASSWORD:
-        raise ValueError("GMAIL_USERNAME hoặc GMAIL_APP_PASSWORD không được đặt.")
-    yag = yagmail.SMTP(GMAIL_USERNAME, GMAIL_APP_PASSWORD)
-    print("Kết nối yagmail SMTP thành công!")
-except Exception as e:
-    print(f"Lỗi khởi tạo yagmail SMTP: {e}")
-    # exit()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await redis_client.ping() # Kiểm tra kết nối và làm nóng pool
+        # Nạp sẵn các script để EVALSHA không bị NOSCRIPT
+        await redis_client.script_load(OTP_VERIFY_LUA)
+        await redis_client.script_load(TOKEN_BUCKET_LUA)
+        await redis_client.script_load(OTP_DISCARD_LUA)
+        print("Kết nối Redis thành công!")
+    except RedisError as e:
+        print(f"Lỗi kết nối Redis: {e}")
+        # exit()
+
+    try:
+        if not GMAIL_USERNAME or not GMAIL_APP_PASSWORD:
+            raise ValueError("GMAIL_USERNAME hoặc GMAIL_APP_PASSWORD không được đặt.")
+        await asyncio.gather(*(connect_smtp(smtp) for smtp in smtp_connections))
+        print("Kết nối SMTP thành công!")
+    except Exception as e:
+        print(f"Lỗi khởi tạo SMTP: {e}")
+        # exit()
+
+    try:
+        await get_google_access_token() # Lấy sẵn access token cho Identity Toolkit
+        print("Khởi tạo Firebase Auth thành công!")
+    except Exception as e:
+        print(f"Lỗi lấy access token Firebase: {e}")
+        # exit()
+
+    yield
 
-app = FastAPI()
+    await http_client.aclose()
+    for smtp in smtp_connections:
+        if smtp.is_connected:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+    await redis_client.aclose()
+    await redis_pool.disconnect()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -82,7 +157,9 @@ class UserResponse(BaseModel):
     email: Optional[EmailStr] = None
     displayName: Optional[str] = None
     disabled: bool
-    photoURL: Optional[HttpUrl] = None # Sử dụng HttpUrl cho validation tốt hơn
+    # Dữ liệu trả về lấy từ Firebase (đã hợp lệ) và được dựng bằng model_construct nên dùng str;
+    # validation HttpUrl chỉ áp dụng cho dữ liệu đầu vào (UserUpdateRequest)
+    photoURL: Optional[str] = None
     # Thêm các trường khác nếu cần, ví dụ: emailVerified, metadata (creationTime, lastSignInTime)
     # emailVerified: bool
     # creationTime: Optional[str] = None # Firebase trả về dạng string, có thể cần parse
@@ -104,55 +181,342 @@ class UserBanStatusRequest(BaseModel):
     disabled: bool
 
 # --- Hằng số ---
-OTP_EXPIRY_SECONDS = 10 * 60  # OTP hết hạn sau 10 phút (600 giây)
-REDIS_OTP_PREFIX = "otp_reset:" # Tiền tố cho key OTP trong Redis
-REDIS_OOB_PREFIX = "oob_reset:" # Tiền tố cho key oobCode trong Redis
+# Ánh xạ trường của UserUpdateRequest -> trường của accounts:update (kèm hàm chuyển đổi nếu cần)
+USER_UPDATE_FIELD_MAP = (
+    ("displayName", "displayName", None),
+    ("email", "email", None),
+    ("password", "password", None),
+    ("photoURL", "photoUrl", str), # Chuyển HttpUrl thành string
+    ("disabled", "disableUser", None), # Cũng có thể dùng endpoint /status riêng
+    ("emailVerified", "emailVerified", None), # Cho phép admin set emailVerified
+)
 
-# --- Hàm tiện ích ---
-def generate_otp(length: int = 4) -> str:
-    return "".join(random.choices(string.digits, k=length))
+OTP_EXPIRY_SECONDS = 10 * 60  # OTP hết hạn sau 10 phút (600 giây)
+REDIS_PWRESET_PREFIX = "pwreset:" # Tiền tố cho hash đặt lại mật khẩu (các field: otp, oob) trong Redis
 
-async def send_email_with_otp_gmail(email_to: str, otp: str):
-    subject = "Mã OTP Đặt Lại Mật Khẩu GearUp"
-    body = f"""
+# Nội dung email OTP, dựng sẵn một lần (thời gian hết hạn đã được điền), chỉ còn {otp}
+OTP_EMAIL_SUBJECT = "Mã OTP Đặt Lại Mật Khẩu GearUp"
+OTP_EMAIL_BODY_TEMPLATE = """
     Chào bạn,
 
     Mã OTP để đặt lại mật khẩu của bạn là: {otp}
 
-    Mã này sẽ hết hạn sau {OTP_EXPIRY_SECONDS // 60} phút.
+    Mã này sẽ hết hạn sau %d phút.
     Nếu bạn không yêu cầu đặt lại mật khẩu, vui lòng bỏ qua email này.
 
     Trân trọng,
     Đội ngũ GearUp
-    """
+    """ % (OTP_EXPIRY_SECONDS // 60)
+
+# Script Lua xác thực OTP: so sánh, lấy oobCode và xóa hash trong một lệnh nguyên tử
+# KEYS[1] = hash đặt lại mật khẩu, KEYS[2] = sorted set các lần nhập sai của email (sliding window)
+# ARGV[1] = OTP người dùng gửi lên, ARGV[2] = số lần nhập sai tối đa, ARGV[3] = thời điểm hiện tại (ms),
+# ARGV[4] = độ dài cửa sổ (ms), ARGV[5] = id duy nhất cho lần nhập sai này
+# Số lần sai được đếm theo email (không reset khi có OTP mới) trong cùng lệnh với phép so sánh:
+# email đã bị khóa thì bị từ chối trước khi so sánh; lần sai đạt giới hạn thì xóa luôn hash
+# Trả về oobCode nếu đúng, hoặc một mã lỗi dạng số (xem OTP_VERIFY_* bên dưới)
+# Việc so sánh OTP nằm trong script (không dùng được hmac.compare_digest phía Python mà
+# vẫn giữ tính nguyên tử). Chuỗi trong Lua của Redis được intern, phép `~=` chỉ so sánh
+# tham chiếu nên thời gian không phụ thuộc vào vị trí ký tự khác nhau đầu tiên.
+OTP_VERIFY_LUA = """
+local max_attempts = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], 0, now - window)
+if redis.call('ZCARD', KEYS[2]) >= max_attempts then
+    return -3
+end
+local fields = redis.call('HMGET', KEYS[1], 'otp', 'oob')
+local stored = fields[1]
+if not stored then
+    return 0
+end
+if stored ~= ARGV[1] then
+    redis.call('ZADD', KEYS[2], now, ARGV[5])
+    redis.call('PEXPIRE', KEYS[2], window)
+    if redis.call('ZCARD', KEYS[2]) >= max_attempts then
+        redis.call('DEL', KEYS[1])
+        return -3
+    end
+    return -1
+end
+local oob = fields[2]
+redis.call('DEL', KEYS[1])
+if not oob then
+    return -2
+end
+return oob
+"""
+OTP_VERIFY_MISSING = 0 # OTP không tồn tại hoặc đã hết hạn
+OTP_VERIFY_MISMATCH = -1 # OTP không khớp
+OTP_VERIFY_NO_OOB = -2 # OTP đúng nhưng không có oobCode đi kèm
+OTP_VERIFY_LOCKED = -3 # Email đã đạt số lần nhập sai tối đa trong cửa sổ, OTP bị hủy
+
+# Giới hạn tần suất yêu cầu OTP (token bucket): tối đa CAPACITY yêu cầu liên tiếp,
+# sau đó được cấp lại 1 lượt mỗi REFILL_MS mili giây
+OTP_RATE_LIMIT_EMAIL_CAPACITY = 5
+OTP_RATE_LIMIT_EMAIL_REFILL_MS = 60 * 1000 # 1 lượt/phút cho mỗi email
+OTP_RATE_LIMIT_IP_CAPACITY = 20 # Rộng hơn theo IP vì nhiều người có thể dùng chung NAT
+OTP_RATE_LIMIT_IP_REFILL_MS = 15 * 1000
+REDIS_RL_OTP_EMAIL_PREFIX = "rl:otp:" # Tiền tố cho bucket theo email
+REDIS_RL_OTP_IP_PREFIX = "rl:otp-ip:" # Tiền tố cho bucket theo IP
+
+# Giới hạn số lần nhập sai OTP (sliding window): đạt MAX lần trong WINDOW_MS thì hủy OTP và khóa email
+OTP_MAX_FAILED_ATTEMPTS = 5
+OTP_FAILED_WINDOW_MS = OTP_EXPIRY_SECONDS * 1000
+REDIS_OTP_FAIL_PREFIX = "rl:otpfail:" # Tiền tố cho sorted set các lần nhập sai
+
+# Cache kết quả kiểm tra email có tồn tại trên Firebase hay không ("1"/"0")
+USER_EXISTS_CACHE_SECONDS = 60
+REDIS_USER_EXISTS_PREFIX = "user_exists:" # Tiền tố cho key cache tồn tại người dùng
+
+# Script Lua token bucket: nạp lại token theo thời gian đã trôi qua rồi trừ 1 token
+# KEYS[1] = key bucket, ARGV[1] = capacity, ARGV[2] = số ms để nạp 1 token, ARGV[3] = thời điểm hiện tại (ms)
+# Trả về 1 nếu được phép, 0 nếu đã hết token
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local refill_ms = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if not tokens then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) / refill_ms)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) * refill_ms))
+return allowed
+"""
+
+# Script Lua hủy OTP khi gửi email thất bại: chỉ xóa hash nếu OTP đang lưu vẫn là OTP vừa gửi,
+# tránh xóa nhầm OTP mới hơn nếu người dùng đã yêu cầu lại trong lúc đó
+# KEYS[1] = hash đặt lại mật khẩu, ARGV[1] = OTP đã gửi; trả về 1 nếu đã xóa, 0 nếu không
+OTP_DISCARD_LUA = """
+if redis.call('HGET', KEYS[1], 'otp') == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# register_script gọi EVALSHA và tự nạp lại script nếu Redis trả về NOSCRIPT
+otp_verify_script = redis_client.register_script(OTP_VERIFY_LUA)
+token_bucket_script = redis_client.register_script(TOKEN_BUCKET_LUA)
+otp_discard_script = redis_client.register_script(OTP_DISCARD_LUA)
+
+# --- Firebase Auth (Identity Toolkit REST API) ---
+class IdentityToolkitError(Exception):
+    """Lỗi trả về từ Identity Toolkit; `code` là mã lỗi của Firebase, ví dụ USER_NOT_FOUND."""
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+
+class UserNotFoundError(IdentityToolkitError):
+    pass
+
+class EmailAlreadyExistsError(IdentityToolkitError):
+    pass
+
+IDENTITY_TOOLKIT_ERRORS = {
+    "USER_NOT_FOUND": UserNotFoundError,
+    "EMAIL_EXISTS": EmailAlreadyExistsError,
+    "DUPLICATE_EMAIL": EmailAlreadyExistsError,
+}
+
+async def get_google_access_token() -> str:
+    if google_credentials is None:
+        raise RuntimeError("Thông tin xác thực Firebase chưa được khởi tạo.")
+    if not google_credentials.valid:
+        async with google_token_lock:
+            if not google_credentials.valid:
+                # refresh() dùng requests (blocking) nên chạy trong thread riêng, chỉ xảy ra khi token hết hạn
+                await asyncio.to_thread(google_credentials.refresh, google.auth.transport.requests.Request())
+    return google_credentials.token
+
+async def identity_toolkit_request(method: str, action: str, body: Optional[dict] = None, params: Optional[dict] = None) -> dict:
+    """Gọi `accounts:<action>` của Identity Toolkit, ném IdentityToolkitError nếu API trả về lỗi."""
+    token = await get_google_access_token()
+    headers = {"Authorization": f"Bearer {token}"}
+    content = None
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+        content = orjson.dumps(body)
+    response = await http_client.request(method, f"{IDENTITY_TOOLKIT_URL}:{action}", headers=headers, content=content, params=params)
+    if response.is_error:
+        try:
+            message = orjson.loads(response.content)["error"]["message"]
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            message = f"HTTP {response.status_code}"
+        code = message.split(" ", 1)[0] # Ví dụ: "WEAK_PASSWORD : Password should be ..."
+        raise IDENTITY_TOOLKIT_ERRORS.get(code, IdentityToolkitError)(code, message)
+    return orjson.loads(response.content)
+
+async def get_user_by_email(email: str) -> Optional[dict]:
+    data = await identity_toolkit_request("POST", "lookup", body={"email": [email]})
+    users = data.get("users")
+    return users[0] if users else None
+
+async def get_user(uid: str) -> dict:
+    data = await identity_toolkit_request("POST", "lookup", body={"localId": [uid]})
+    users = data.get("users")
+    if not users:
+        raise UserNotFoundError("USER_NOT_FOUND", f"Không tìm thấy người dùng với UID: {uid}")
+    return users[0]
+
+async def generate_password_reset_link(email: str) -> str:
+    data = await identity_toolkit_request(
+        "POST", "sendOobCode", body={"requestType": "PASSWORD_RESET", "email": email, "returnOobLink": True}
+    )
+    return data["oobLink"]
+
+async def update_user(uid: str, **fields: Any) -> dict:
+    """Cập nhật người dùng; `fields` dùng tên trường của REST API (displayName, photoUrl, disableUser, ...)."""
+    await identity_toolkit_request("POST", "update", body={"localId": uid, **fields})
+    # accounts:update không trả về đầy đủ bản ghi (ví dụ thiếu disabled) nên đọc lại, giống firebase_admin
+    return await get_user(uid)
+
+async def list_users(page_token: Optional[str] = None, max_results: int = 1000) -> dict:
+    params = {"maxResults": max_results}
+    if page_token:
+        params["nextPageToken"] = page_token
+    return await identity_toolkit_request("GET", "batchGet", params=params)
+
+# --- Hàm tiện ích ---
+def to_user_response(user: dict) -> UserResponse:
+    # Dữ liệu từ Firebase đã hợp lệ nên dùng model_construct để bỏ qua validation
+    get = user.get
+    return UserResponse.model_construct(
+        uid=user["localId"],
+        email=get("email"),
+        displayName=get("displayName"),
+        disabled=get("disabled", False),
+        photoURL=get("photoUrl") or None, # Xử lý nếu photoUrl không có
+        # emailVerified=get("emailVerified", False),
+        # creationTime=get("createdAt"), # Timestamp dạng chuỗi mili giây, cần parse
+        # lastSignInTime=get("lastLoginAt"),
+    )
+
+def generate_otp(length: int = 4) -> str:
+    return f"{randbelow(10 ** length):0{length}d}"
+
+def extract_oob_code(link: str) -> Optional[str]:
+    # Dùng parser của urllib thay cho regex/str.find: xử lý được giá trị bị URL-encode
+    # và thứ tự tham số bất kỳ trong query string
+    return parse_qs(urlsplit(link).query).get("oobCode", [None])[0]
+
+def get_client_ip(request: Request) -> str:
+    # Service chạy sau proxy của Render, proxy này nối IP thật của client vào cuối X-Forwarded-For.
+    # Chỉ tin hop cuối cùng: các giá trị phía trước do client tự gửi nên có thể bị giả mạo.
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if forwarded_for:
+        client_ip = forwarded_for.rsplit(",", 1)[-1].strip()
+        if client_ip:
+            return client_ip
+    return request.client.host if request.client else "unknown"
+
+async def rate_limit(key: bytes, capacity: int, refill_ms: int) -> bool:
+    """Lấy 1 token từ bucket `key`. Trả về False nếu đã vượt giới hạn."""
+    now_ms = int(time.time() * 1000)
+    allowed = await token_bucket_script(keys=[key], args=[capacity, refill_ms, now_ms])
+    return allowed == 1
+
+async def user_exists(email: str) -> bool:
+    """Kiểm tra email có tài khoản Firebase hay không, ưu tiên dùng kết quả cache trong Redis."""
+    email = email.lower()
+    cache_key = (REDIS_USER_EXISTS_PREFIX + email).encode()
+    try:
+        cached = await redis_client.get(cache_key)
+    except RedisError as e:
+        print(f"Lỗi Redis khi đọc cache người dùng: {e}")
+        cached = None
+    if cached is not None:
+        return cached == "1"
+
+    # Cache miss: hỏi Firebase
+    exists = await get_user_by_email(email) is not None
+
+    try:
+        await redis_client.setex(cache_key, USER_EXISTS_CACHE_SECONDS, "1" if exists else "0")
+    except RedisError as e:
+        print(f"Lỗi Redis khi ghi cache người dùng: {e}")
+    return exists
+
+async def send_email_with_otp_gmail(email_to: str, otp: str):
+    msg = EmailMessage()
+    msg["From"] = GMAIL_USERNAME
+    msg["To"] = email_to
+    msg["Subject"] = OTP_EMAIL_SUBJECT
+    msg.set_content(OTP_EMAIL_BODY_TEMPLATE.format(otp=otp))
+
+    smtp = await smtp_pool.get()
     try:
-        yag.send(to=email_to, subject=subject, contents=body)
+        if not smtp.is_connected:
+            await connect_smtp(smtp)
+        try:
+            await smtp.send_message(msg)
+        except aiosmtplib.SMTPServerDisconnected:
+            # Server đã đóng kết nối (ví dụ do để idle quá lâu), kết nối lại và gửi lại một lần
+            smtp.close()
+            await connect_smtp(smtp)
+            await smtp.send_message(msg)
         print(f"Đã gửi email OTP tới: {email_to}")
         return True
     except Exception as e:
         print(f"Lỗi khi gửi email OTP tới {email_to}: {e}")
         return False
+    finally:
+        smtp_pool.put_nowait(smtp)
+
+async def send_otp_email_task(email: str, otp: str):
+    """Chạy nền: gửi email OTP, nếu thất bại thì xóa OTP/oobCode (nếu chưa bị OTP mới thay thế) để người dùng có thể yêu cầu lại."""
+    email_sent = await send_email_with_otp_gmail(email, otp)
+    if not email_sent:
+        try:
+            await otp_discard_script(keys=[(REDIS_PWRESET_PREFIX + email).encode()], args=[otp])
+        except RedisError as e:
+            print(f"Lỗi Redis khi xóa key: {e}")
 
 # --- API Endpoints cho quên mật khẩu ---
 
 @app.post("/request-password-otp-and-code", status_code=status.HTTP_200_OK)
-async def request_password_otp_and_code(request: EmailRequest):
-    email = request.email
+async def request_password_otp_and_code(request: EmailRequest, http_request: Request, background_tasks: BackgroundTasks):
+    # Firebase không phân biệt hoa/thường trong email; chuẩn hóa trước khi dựng key Redis
+    # để các biến thể hoa/thường không có bucket/OTP riêng
+    email = request.email.lower()
+    client_ip = get_client_ip(http_request)
+    # Dựng các key Redis một lần dưới dạng bytes để redis-py không phải encode lại mỗi lệnh
+    pwreset_key = (REDIS_PWRESET_PREFIX + email).encode()
+    rl_email_key = (REDIS_RL_OTP_EMAIL_PREFIX + email).encode()
+    rl_ip_key = (REDIS_RL_OTP_IP_PREFIX + client_ip).encode()
+
     try:
-        user = auth.get_user_by_email(email)
-    except auth.UserNotFoundError:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Email không tồn tại.")
+        allowed = (
+            await rate_limit(rl_email_key, OTP_RATE_LIMIT_EMAIL_CAPACITY, OTP_RATE_LIMIT_EMAIL_REFILL_MS)
+            and await rate_limit(rl_ip_key, OTP_RATE_LIMIT_IP_CAPACITY, OTP_RATE_LIMIT_IP_REFILL_MS)
+        )
+    except RedisError as e:
+        print(f"Lỗi Redis khi kiểm tra giới hạn tần suất: {e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi lưu trữ tạm thời.")
+    if not allowed:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Bạn đã yêu cầu OTP quá nhiều lần. Vui lòng thử lại sau.")
+
+    try:
+        exists = await user_exists(email)
     except Exception as e:
         print(f"Lỗi get_user_by_email: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi máy chủ khi kiểm tra email.")
+    if not exists:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Email không tồn tại.")
 
     try:
-        link = auth.generate_password_reset_link(email)
-        if "oobCode=" not in link:
-            raise ValueError("Không thể tạo link reset.")
-        oob_code_start = link.find("oobCode=") + len("oobCode=")
-        oob_code_end = link.find("&", oob_code_start)
-        oob_code = link[oob_code_start:oob_code_end if oob_code_end != -1 else None]
+        link = await generate_password_reset_link(email)
+        oob_code = extract_oob_code(link)
         if not oob_code:
             raise ValueError("Không thể trích xuất oobCode.")
     except Exception as e:
@@ -161,67 +525,63 @@ async def request_password_otp_and_code(request: EmailRequest):
 
     otp = generate_otp(length=4)
 
-    # Lưu OTP và oobCode vào Redis với thời gian hết hạn
-    # Key cho OTP: otp_reset:email@example.com
-    # Key cho oobCode: oob_reset:email@example.com (sẽ được lấy sau khi OTP đúng)
+    # Lưu OTP và oobCode vào Redis với thời gian hết hạn, trong cùng một hash:
+    # pwreset:email@example.com -> {otp: OTP sẽ được kiểm tra trước, oob: oobCode trả về nếu OTP đúng}
+    # HSET + EXPIRE được ghi trong một pipeline (MULTI/EXEC) -> một round-trip tới Redis
     try:
-        # Lưu OTP, sẽ được kiểm tra trước
-        redis_client.setex(f"{REDIS_OTP_PREFIX}{email}", OTP_EXPIRY_SECONDS, otp)
-        # Lưu oobCode, sẽ được trả về nếu OTP đúng
-        redis_client.setex(f"{REDIS_OOB_PREFIX}{email}", OTP_EXPIRY_SECONDS, oob_code) # oobCode cũng có thể hết hạn theo OTP
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(pwreset_key, mapping={"otp": otp, "oob": oob_code})
+            pipe.expire(pwreset_key, OTP_EXPIRY_SECONDS) # oobCode hết hạn cùng OTP
+            await pipe.execute()
         print(f"Đã lưu vào Redis cho {email}: OTP={otp}, oobCode={oob_code[:10]}...")
-    except redis.exceptions.RedisError as e:
+    except RedisError as e:
         print(f"Lỗi Redis khi lưu trữ: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi lưu trữ tạm thời.")
 
 
-    email_sent = await send_email_with_otp_gmail(email, otp)
-    if not email_sent:
-        # Nếu không gửi được email, xóa key khỏi Redis
-        redis_client.delete(f"{REDIS_OTP_PREFIX}{email}")
-        redis_client.delete(f"{REDIS_OOB_PREFIX}{email}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi gửi email OTP.")
+    # Gửi email sau khi đã trả response, không bắt client chờ SMTP
+    background_tasks.add_task(send_otp_email_task, email, otp)
 
     return {"message": f"OTP đã được gửi tới {email}. Vui lòng kiểm tra email."}
 
 
 @app.post("/verify-otp-and-get-code", status_code=status.HTTP_200_OK)
 async def verify_otp_and_get_code(request: VerifyOtpRequest):
-    email = request.email
+    # Firebase không phân biệt hoa/thường trong email; chuẩn hóa trước khi dựng key Redis
+    # để các biến thể hoa/thường không có bucket/OTP riêng
+    email = request.email.lower()
     submitted_otp = request.otp
+    # Dựng key Redis một lần dưới dạng bytes để redis-py không phải encode lại
+    pwreset_key = (REDIS_PWRESET_PREFIX + email).encode()
+    otp_fail_key = (REDIS_OTP_FAIL_PREFIX + email).encode()
+    now_ms = int(time.time() * 1000)
 
     try:
-        stored_otp = redis_client.get(f"{REDIS_OTP_PREFIX}{email}")
-    except redis.exceptions.RedisError as e:
-        print(f"Lỗi Redis khi lấy OTP: {e}")
+        result = await otp_verify_script(
+            keys=[pwreset_key, otp_fail_key],
+            args=[submitted_otp, OTP_MAX_FAILED_ATTEMPTS, now_ms, OTP_FAILED_WINDOW_MS, uuid.uuid4().hex],
+        )
+    except RedisError as e:
+        print(f"Lỗi Redis khi xác thực OTP: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi truy xuất dữ liệu.")
 
-    if not stored_otp:
+    if result == OTP_VERIFY_MISSING:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="OTP không tồn tại hoặc đã hết hạn. Vui lòng yêu cầu mã mới.")
 
-    if stored_otp != submitted_otp:
-        # (Tùy chọn) Có thể thêm logic đếm số lần nhập sai và khóa tạm thời
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Mã OTP không chính xác.")
+    if result == OTP_VERIFY_LOCKED:
+        # Email bị khóa tới khi các lần nhập sai cũ ra khỏi cửa sổ; script đã hủy OTP để chống dò mã
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=f"Bạn đã nhập sai OTP quá nhiều lần. Vui lòng thử lại sau {OTP_FAILED_WINDOW_MS // 60000} phút.")
 
-    # OTP hợp lệ, lấy oobCode
-    try:
-        oob_code_to_return = redis_client.get(f"{REDIS_OOB_PREFIX}{email}")
-        if not oob_code_to_return:
-            # Trường hợp này không nên xảy ra nếu logic lưu trữ ở trên là đúng
-            # (oobCode nên được lưu cùng lúc với OTP)
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi: Không tìm thấy mã đặt lại tương ứng.")
-    except redis.exceptions.RedisError as e:
-        print(f"Lỗi Redis khi lấy oobCode: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi truy xuất mã đặt lại.")
+    if result == OTP_VERIFY_MISMATCH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Mã OTP không chính xác.")
 
+    if result == OTP_VERIFY_NO_OOB:
+        # Trường hợp này không nên xảy ra nếu logic lưu trữ ở trên là đúng
+        # (oobCode nên được lưu cùng lúc với OTP)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi: Không tìm thấy mã đặt lại tương ứng.")
 
-    # Xóa OTP và oobCode khỏi Redis sau khi đã xác thực thành công
-    try:
-        redis_client.delete(f"{REDIS_OTP_PREFIX}{email}")
-        redis_client.delete(f"{REDIS_OOB_PREFIX}{email}")
-    except redis.exceptions.RedisError as e:
-        print(f"Lỗi Redis khi xóa key: {e}")
-        # Không raise HTTP Exception ở đây, vì OTP đã đúng, chỉ là lỗi dọn dẹp
+    # OTP hợp lệ, script đã xóa OTP và oobCode khỏi Redis
+    oob_code_to_return = result
 
     print(f"OTP cho {email} đã được xác thực. Trả về oobCode.")
     return {"message": "OTP xác thực thành công.", "oobCode": oob_code_to_return}
@@ -242,26 +602,41 @@ async def list_all_users(page_token: Optional[str] = None, max_results: int = 10
         if max_results > 1000:
             max_results = 1000
             
-        page = auth.list_users(page_token=page_token, max_results=max_results)
-        users_data = [
-            UserResponse(
-                uid=user.uid,
-                email=user.email,
-                displayName=user.display_name,
-                disabled=user.disabled,
-                photoURL=user.photo_url if user.photo_url else None, # Xử lý nếu photo_url là None
-                # emailVerified=user.email_verified,
-                # creationTime=user.user_metadata.creation_timestamp if user.user_metadata else None, # Cần parse timestamp
-                # lastSignInTime=user.user_metadata.last_sign_in_timestamp if user.user_metadata else None,
-            )
-            for user in page.users
-        ]
-        return UserListResponse(users=users_data, nextPageToken=page.next_page_token)
+        page = await list_users(page_token=page_token, max_results=max_results)
+        users_data = [to_user_response(user) for user in page.get("users", [])]
+        response = UserListResponse.model_construct(users=users_data, nextPageToken=page.get("nextPageToken"))
+        # Trả về Response trực tiếp để FastAPI không validate lại theo response_model
+        return ORJSONResponse(content=response.model_dump())
     except Exception as e:
         print(f"Lỗi khi lấy danh sách người dùng: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Lỗi máy chủ khi lấy danh sách người dùng.")
 
 
+@app.get("/users/stream", summary="Lấy toàn bộ người dùng dạng NDJSON")
+async def stream_all_users():
+    """
+    Trả về toàn bộ người dùng, mỗi dòng là một đối tượng JSON (NDJSON).
+    Dữ liệu được gửi dần theo từng trang của Firebase nên không cần giữ toàn bộ danh sách trong bộ nhớ.
+    """
+    async def generate_users():
+        page_token = None
+        try:
+            while True:
+                page = await list_users(page_token=page_token, max_results=1000)
+                for user in page.get("users", []):
+                    yield orjson.dumps(to_user_response(user).model_dump()) + b"\n"
+                page_token = page.get("nextPageToken")
+                if not page_token:
+                    break
+        except Exception as e:
+            # Response đã bắt đầu gửi nên không thể trả về mã lỗi HTTP; ném lại lỗi để server hủy kết nối
+            # giữa chừng, client nhận được response không hoàn chỉnh thay vì một danh sách thiếu mà trông như đủ
+            print(f"Lỗi khi stream danh sách người dùng: {e}")
+            raise
+
+    return StreamingResponse(generate_users(), media_type="application/x-ndjson")
+
+
 @app.put("/users/{user_uid}/status", response_model=UserResponse, summary="Cấm hoặc hủy cấm người dùng")
 async def set_user_ban_status(user_uid: str, request: UserBanStatusRequest):
     """
@@ -270,15 +645,9 @@ async def set_user_ban_status(user_uid: str, request: UserBanStatusRequest):
     - `request.disabled`: `true` để cấm, `false` để hủy cấm.
     """
     try:
-        updated_user_record = auth.update_user(user_uid, disabled=request.disabled)
-        return UserResponse(
-            uid=updated_user_record.uid,
-            email=updated_user_record.email,
-            displayName=updated_user_record.display_name,
-            disabled=updated_user_record.disabled,
-            photoURL=updated_user_record.photo_url if updated_user_record.photo_url else None
-        )
-    except auth.UserNotFoundError:
+        updated_user_record = await update_user(user_uid, disableUser=request.disabled)
+        return to_user_response(updated_user_record)
+    except UserNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Không tìm thấy người dùng với UID: {user_uid}")
     except Exception as e:
         print(f"Lỗi khi cập nhật trạng thái cấm của người dùng {user_uid}: {e}")
@@ -291,40 +660,32 @@ async def update_user_info(user_uid: str, request: UserUpdateRequest):
     Cập nhật thông tin cho một người dùng cụ thể.
     Chỉ các trường được cung cấp trong request body mới được cập nhật.
     """
-    update_payload: Dict[str, Any] = {}
-    if request.displayName is not None:
-        update_payload["display_name"] = request.displayName
-    if request.email is not None:
-        update_payload["email"] = request.email
-        # Khi cập nhật email qua Admin SDK, emailVerified tự động thành False
-        # Bạn có thể set emailVerified thành True nếu muốn xác minh ngay
-        # update_payload["email_verified"] = False # Mặc định của Firebase
-    if request.password is not None:
-        if len(request.password) < 6: # Firebase yêu cầu mật khẩu ít nhất 6 ký tự
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Mật khẩu phải có ít nhất 6 ký tự.")
-        update_payload["password"] = request.password
-    if request.photoURL is not None:
-        update_payload["photo_url"] = str(request.photoURL) # Chuyển HttpUrl thành string
-    if request.disabled is not None: # Cũng có thể dùng endpoint /status riêng
-        update_payload["disabled"] = request.disabled
-    if request.emailVerified is not None: # Cho phép admin set emailVerified
-        update_payload["email_verified"] = request.emailVerified
+    data = request.model_dump(exclude_none=True)
+    if "password" in data and len(data["password"]) < 6: # Firebase yêu cầu mật khẩu ít nhất 6 ký tự
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Mật khẩu phải có ít nhất 6 ký tự.")
+    # Khi cập nhật email, emailVerified tự động thành False
+    # Bạn có thể gửi kèm emailVerified=true nếu muốn xác minh ngay
+    update_payload: dict[str, Any] = {
+        dst: (transform(data[src]) if transform else data[src])
+        for src, dst, transform in USER_UPDATE_FIELD_MAP
+        if src in data
+    }
 
     if not update_payload:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Không có thông tin nào được cung cấp để cập nhật.")
 
     try:
-        updated_user_record = auth.update_user(user_uid, **update_payload)
-        return UserResponse(
-            uid=updated_user_record.uid,
-            email=updated_user_record.email,
-            displayName=updated_user_record.display_name,
-            disabled=updated_user_record.disabled,
-            photoURL=updated_user_record.photo_url if updated_user_record.photo_url else None
-        )
-    except auth.UserNotFoundError:
+        updated_user_record = await update_user(user_uid, **update_payload)
+        if "email" in update_payload:
+            # Email mới có thể đang bị cache là "không tồn tại"
+            try:
+                await redis_client.delete((REDIS_USER_EXISTS_PREFIX + updated_user_record["email"].lower()).encode())
+            except RedisError as e:
+                print(f"Lỗi Redis khi xóa cache người dùng: {e}")
+        return to_user_response(updated_user_record)
+    except UserNotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Không tìm thấy người dùng với UID: {user_uid}")
-    except auth.EmailAlreadyExistsError: # Nếu email mới đã được sử dụng
+    except EmailAlreadyExistsError: # Nếu email mới đã được sử dụng
          raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Địa chỉ email mới đã được sử dụng bởi tài khoản khác.")
     except Exception as e:
         print(f"Lỗi khi cập nhật thông tin người dùng {user_uid}: {e}")